@@ -0,0 +1,66 @@
+#! /usr/bin/python3
+import argparse
+import timeit
+import numpy as np
+import pandas as pd
+import netfonds_utils as nu
+
+
+def synthetic_times(n_rows):
+    """Netfonds time strings of n_rows ticks during one trading day.
+    """
+    rng = np.random.default_rng(0)
+    seconds = np.sort(rng.integers(0, 8*3600, n_rows)).astype('timedelta64[s]')
+    times = np.datetime64('2019-01-30T09:00:00') + seconds
+
+    return nu.format_sheet_times(times, nu.NETFONDS_TIME_FORMAT)
+
+
+def best_of(func, repeat, number=1):
+    """Best time per call in seconds.
+    """
+    return min(timeit.repeat(func, repeat=repeat, number=number)) / number
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Micro-benchmarks of timestamp parsing and formatting.')
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    strings = synthetic_times(args.rows)
+    times = nu.parse_netfonds_times(strings)
+    series = pd.Series(pd.DatetimeIndex(times))
+
+    # (name, baseline, vectorized)
+    cases = [
+        (
+            'parse',
+            ('strptime', lambda: [nu.parse_netfonds_time(s) for s in strings]),
+            ('parse_netfonds_times', lambda: nu.parse_netfonds_times(strings))
+        ),
+        (
+            'parse',
+            ('pd.to_datetime',
+             lambda: pd.to_datetime(strings, format=nu.NETFONDS_TIME_FORMAT)),
+            ('parse_netfonds_times', lambda: nu.parse_netfonds_times(strings))
+        ),
+        (
+            'format',
+            ('map(str)', lambda: series.map(str)),
+            ('format_sheet_times', lambda: nu.format_sheet_times(times))
+        ),
+    ]
+
+    print('rows: {}'.format(args.rows))
+    for name, (base_name, base), (vec_name, vec) in cases:
+        base_time = best_of(base, args.repeat)
+        vec_time = best_of(vec, args.repeat)
+        print('{:<7}{:>16}: {:8.2f} ms  {:>22}: {:8.2f} ms  ({:.1f}x)'.format(
+            name, base_name, base_time*1e3, vec_name, vec_time*1e3,
+            base_time / vec_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,100 @@
 import json
+import time
+import threading
 import requests as r
 import google.oauth2.credentials
 
+from collections import OrderedDict
+
+
+class TTLCache(object):
+    """Thread safe in-process cache for idempotent API reads within a run.
+    Entries expire after ttl seconds, least recently used entries are 
+    evicted above maxsize.
+    
+    # Parameters:
+        ttl: float
+            Seconds an entry is valid.
+        maxsize: int
+            Max number of entries.
+    """
+    def __init__(self, ttl=600, maxsize=256):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        
+    def get(self, key, func):
+        """Get cached value of key, or call func and cache its return value.
+        
+        # Parameters:
+            key: hashable
+            func: callable
+                Called without arguments on cache miss.
+        # Returns:
+            value
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.time() - entry[0] < self.ttl:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        
+        value = func()
+        with self._lock:
+            self._entries[key] = (time.time(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                
+        return value
+    
+    def invalidate(self, key=None):
+        """Remove key from cache. Clears the cache if key is not passed.
+        """
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+                
+    def stats(self):
+        """Hit and miss counters.
+        
+        # Returns:
+            _: dict
+        """
+        with self._lock:
+            return {
+                'hits': self.hits, 
+                'misses': self.misses, 
+                'size': len(self._entries)
+            }
+        
+
+# Client secret file contents, shared by all sessions
+secrets_cache = TTLCache(ttl=3600, maxsize=8)
+
+
+def read_client_secret(filename='assets/client_secret.json'):
+    """Read and parse json client secrets, memoized in secrets_cache.
+    
+    # Parameters:
+        filename: str
+    # Returns:
+        _: dict
+            'web' client secrets.
+    """
+    def read():
+        with open(filename) as f:
+            return json.load(f)['web']
+    
+    return secrets_cache.get(filename, read)
+
 
 def get_access_token(filename='assets/client_secret.json'):
     """Get Google API access token.
@@ -13,8 +106,7 @@ def get_access_token(filename='assets/client_secret.json'):
         _: str
             Access token string from post request response.
     """
-    with open(filename) as f:
-        data = json.load(f)['web']
+    data = read_client_secret(filename)
     
     body = {
         'client_id': data['client_id'],
@@ -44,8 +136,7 @@ def get_credentials(filename='assets/client_secret.json', scopes=None, access_to
         credentials: google.oauth2.credentials.Credentials object
     """
     # Open client secret file
-    with open(filename) as f:
-        data = json.load(f)['web']
+    data = read_client_secret(filename)
     
     # Credential parameters
     cred_params = {
@@ -113,9 +204,51 @@ def create_file(drive, name, folder_id, mimeType='application/vnd.google-apps.sp
     return file
 
 
+def sheet_header_keys(ohlc=False, features=False):
+    """Column titles of netfonds sheets.
+    
+    # Parameters:
+        ohlc: boolean
+            Resampled sheet header, otherwise posdump header.
+        features: boolean
+            Add order book feature columns to ohlc header.
+    # Returns:
+        keys: list of str
+    """
+    if not ohlc:
+        return [
+            'time',
+            'bid',
+            'bid_depth',
+            'bid_depth_total',
+            'offer',
+            'offer_depth',
+            'offer_depth_total'
+        ]
+    keys = [
+        'time',
+        'bid_open', 'bid_high', 'bid_low', 'bid_close',
+        'bid_depth', 
+        'bid_depth_total_open', 'bid_depth_total_high', 
+        'bid_depth_total_low', 'bid_depth_total_close',
+        'offer_depth', 
+        'offer_depth_total_open', 'offer_depth_total_high', 
+        'offer_depth_total_low', 'offer_depth_total_close',
+        'spread'
+    ]
+    if features:
+        keys += [
+            'mid_open', 'mid_high', 'mid_low', 'mid_close',
+            'bid_vwap', 'offer_vwap', 'microprice',
+            'imbalance', 'spread_twa'
+        ]
+    return keys
+
+
 # > Maybe unecessary in netfonds-cron
-def populate_sheet_header(gc=None, sheet_name=None, sps=None, ohlc=False):
+def populate_sheet_header(gc=None, sheet_name=None, sps=None, ohlc=False, features=False):
     """Give sheet netfonds column title.
+    Overwrites an existing header, ex. to extend it with features.
     
     # Parameters:
         gc: Sheet API client
@@ -125,68 +258,230 @@ def populate_sheet_header(gc=None, sheet_name=None, sps=None, ohlc=False):
         sps:  gspread.models.Spreadsheet
             If the spreadsheet is opened already, pass this.
             Reduces redundant API calls.
+        features: boolean
+            Add order book feature columns to ohlc header.
     """
     # Spreadsheet open and append
     if sps is None:
         sps = gc.open(sheet_name)
         
-    if not ohlc:
-        body = {'values': [
-            ['time',
-             'bid',
-             'bid_depth',
-             'bid_depth_total',
-             'offer',
-             'offer_depth',
-             'offer_depth_total']
-        ]}
-        response = sps.values_update(
-            range='Sheet1!A1:G1', 
-            body=body, 
-            params={'valueInputOption': 'RAW'}
-        )
-    else:
-        body = {'values': [   
-            ['time',
-            'bid_open', 'bid_high', 'bid_low', 'bid_close',
-            'bid_depth', 
-            'bid_depth_total_open', 'bid_depth_total_high', 
-            'bid_depth_total_low', 'bid_depth_total_close',
-            'offer_depth', 
-            'offer_depth_total_open', 'offer_depth_total_high', 
-            'offer_depth_total_low', 'offer_depth_total_close',
-            'spread']      
-        ]}
-        response = sps.values_update(
-            range='Sheet1!A1:P1', 
-            body=body, 
-            params={'valueInputOption': 'RAW'}
-        )
+    body = {'values': [sheet_header_keys(ohlc=ohlc, features=features)]}
+    last_col = chr(ord('A') + len(body['values'][0]) - 1)
+    response = sps.values_update(
+        range='Sheet1!A1:{}1'.format(last_col), 
+        body=body, 
+        params={'valueInputOption': 'RAW'}
+    )
     
     return response
     
 
-def sheet_append(gc, sheet_name, np_data):
-    """Append numpy array data to end of sheet.
+class ChunkedAppendError(Exception):
+    """Chunked sheet append failed part way.
+    
+    # Attributes:
+        acked_rows: int
+            Rows of the data acknowledged by the API before the failure.
+            Pass as start_row to sheet_append to resume.
+        error: Exception
+            Exception raised by the failing chunk.
+    """
+    def __init__(self, acked_rows, error):
+        super(ChunkedAppendError, self).__init__(
+            'Append failed after {} acknowledged rows: {}'.format(acked_rows, error))
+        self.acked_rows = acked_rows
+        self.error = error
+
+
+def iter_row_chunks(np_data, start_row=0, chunk_rows=5000, 
+                    chunk_bytes=2*1024**2, block_rows=1000):
+    """Stream data rows as list-of-lists chunks, bounded by both 
+    row count and approximate json body size. Rows are serialized 
+    block_rows at a time, the full list-of-lists is never built.
+    
+    # Parameters:
+        np_data: pd.DataFrame
+        start_row: int
+            First row of np_data to stream.
+        chunk_rows: int
+            Max rows per chunk.
+        chunk_bytes: int
+            Max approximate json size of the rows in a chunk.
+        block_rows: int
+            Rows converted to python lists at a time.
+    # Yields:
+        offset, rows: int, list of lists
+            Row offset of the chunk in np_data, and the chunk rows.
+    """
+    rows = []
+    n_bytes = 0
+    offset = start_row
+    for block_start in range(start_row, len(np_data), block_rows):
+        block = np_data.iloc[block_start:block_start + block_rows].values.tolist()
+        for row in block:
+            row_bytes = len(json.dumps(row)) + 1
+            if rows and (len(rows) >= chunk_rows or n_bytes + row_bytes > chunk_bytes):
+                yield offset, rows
+                offset += len(rows)
+                rows = []
+                n_bytes = 0
+            rows.append(row)
+            n_bytes += row_bytes
+    if rows:
+        yield offset, rows
+        
+
+def throttle(limiter=None):
+    """Wait for limiter before an API request, if passed.
+    
+    # Parameters:
+        limiter: touch.BurstLimiter or None
+    """
+    if limiter is not None:
+        limiter.wait()
+
+
+def open_spreadsheet(gc, sheet_name, cache=None, limiter=None):
+    """Open spreadsheet by name, memoized in cache if passed.
+    
+    # Parameters:
+        gc: Sheet API client
+        sheet_name: str
+        cache: TTLCache
+            Should be invalidated when gc is reauthorized.
+        limiter: touch.BurstLimiter
+            Waited on before the request. Cache hits are not throttled.
+    # Returns:
+        _: gspread.models.Spreadsheet
+    """
+    def open_sps():
+        throttle(limiter)
+        return gc.open(sheet_name)
+    
+    if cache is None:
+        return open_sps()
+    return cache.get(('spreadsheet', sheet_name), open_sps)
+
+
+def open_worksheet(gc, sheet_name, cache=None, limiter=None):
+    """Open first worksheet of spreadsheet, memoized in cache if passed.
+    Worksheet metadata is fetched once per cache entry.
+    
+    # Parameters:
+        gc: Sheet API client
+        sheet_name: str
+        cache: TTLCache
+        limiter: touch.BurstLimiter
+            Waited on before each request. Cache hits are not throttled.
+    # Returns:
+        _: gspread.models.Worksheet
+    """
+    def open_wks():
+        sps = open_spreadsheet(gc, sheet_name, cache, limiter)
+        throttle(limiter)
+        return sps.sheet1
+    
+    if cache is None:
+        return open_wks()
+    return cache.get(('worksheet', sheet_name), open_wks)
+
+
+def sheet_append(gc, sheet_name, np_data, start_row=0, 
+                 chunk_rows=5000, chunk_bytes=2*1024**2, cache=None, limiter=None):
+    """Append numpy array data to end of sheet in chunks.
     
     # Parameters:
         gc: Sheet API client
         sheet_name: str
-        np_data: np.array
+        np_data: pd.DataFrame
+        start_row: int
+            Resume from this row of np_data, 
+            ex. ChunkedAppendError.acked_rows of a failed append.
+        chunk_rows, chunk_bytes: int
+            Max rows and approximate json bytes per append request.
+        cache: TTLCache
+            Spreadsheet handle cache, if used.
+        limiter: touch.BurstLimiter
+            Waited on before every request, including each chunk.
+    # Returns:
+        response: dict
+            Summed 'updates' of all chunk responses.
+    # Raises:
+        ChunkedAppendError if a chunk fails.
     """
     # Spreadsheet open and append
-    sps = gc.open(sheet_name)
-    body = {'values': np_data.values.tolist()}
-    response = sps.values_append(
-        range='Sheet1!A1', 
-        body=body, 
-        params={'valueInputOption': 'RAW'}
+    sps = open_spreadsheet(gc, sheet_name, cache, limiter)
+    acked_rows = start_row
+    response = {
+        'updates': {'updatedRows': 0, 'updatedCells': 0},
+        'chunks': 0
+    }
+    chunks = iter_row_chunks(
+        np_data, start_row=start_row, 
+        chunk_rows=chunk_rows, chunk_bytes=chunk_bytes
     )
+    for offset, rows in chunks:
+        throttle(limiter)
+        try:
+            chunk_response = sps.values_append(
+                range='Sheet1!A1', 
+                body={'values': rows}, 
+                params={'valueInputOption': 'RAW'}
+            )
+        except Exception as e:
+            raise ChunkedAppendError(acked_rows, e)
+        acked_rows = offset + len(rows)
+        
+        updates = chunk_response.get('updates', {})
+        response['updates']['updatedRows'] += updates.get('updatedRows', 0)
+        response['updates']['updatedCells'] += updates.get('updatedCells', 0)
+        response['chunks'] += 1
+    response['ackedRows'] = acked_rows
     
     return response
 
 
-def last_filled_cell(worksheet, col=1):
+def api_error_code(e):
+    """HTTP status code of a Sheets/Drive API exception, if any.
+    
+    # Parameters:
+        e: Exception
+            Ex. gspread.exceptions.APIError
+    # Returns:
+        code: int or None
+    """
+    response = getattr(e, 'response', None)
+    code = getattr(response, 'status_code', None)
+    if code is None and e.args and isinstance(e.args[0], dict):
+        code = e.args[0].get('error', {}).get('code')
+        
+    return code
+
+
+def sheet_header(worksheet, sheet_name=None, cache=None, limiter=None):
+    """First row of worksheet, memoized in cache by sheet_name if passed.
+    
+    # Parameters:
+        worksheet: gspread.models.Worksheet
+        sheet_name: str
+            Cache key, required with cache.
+        cache: TTLCache
+        limiter: touch.BurstLimiter
+            Waited on before the request. Cache hits are not throttled.
+    # Returns:
+        header: list of str
+            Empty if the sheet is empty.
+    """
+    def read_header():
+        throttle(limiter)
+        return worksheet.row_values(1)
+    
+    if cache is None:
+        return read_header()
+    return cache.get(('header', sheet_name), read_header)
+
+
+def last_filled_cell(worksheet, col=1, limiter=None):
     """Get last non-empty cell from worksheet col.
     
     # Parameters:
@@ -194,14 +489,18 @@ def last_filled_cell(worksheet, col=1):
             Gspread worksheet, G-Sheets API wrapper
         col: int
             column index (columns start at 1)
+        limiter: touch.BurstLimiter
+            Waited on before each request, if passed.
     # Returns:
         val: str
             value of first non-empty cell in worksheet col
             if worksheet is empty, val = ''
     """
+    throttle(limiter)
     str_list = list(filter(None, worksheet.col_values(1)))  # fastest
     index = len(str_list)
     if index:
+        throttle(limiter)
         val = worksheet.cell(index, col).value
         return val
     else:
@@ -12,9 +12,18 @@ def lambda_handler(event, context):
         'date': '%Y%m%d'
             Ex. 20190130
         'tickers': 'ticker1 ticker2 ... tickerN'
-            Space separated string
+            Space separated string, ex. 'DNB EQNR.OSE'
             If not passed, all tickers in tickerfile will be updated.
-        'granularity': '1T'        
+        'granularity': '1T'
+        'exchanges': 'exchange1 ... exchangeN'
+            Space separated string, ex. 'OSE'
+            If not passed, all exchanges in the ticker registry will be updated.
+            If passed with tickers, every ticker must be on one of exchanges,
+            unqualified tickers are on OSE. Ex. tickers='DNB' with 
+            exchanges='ST' raises ValueError, use tickers='DNB.ST'.
+        'max_workers': '4'
+        'features': 'True'
+            If passed, add order book features to resampled sheets.
     """
     # Log configuration
     root = logging.getLogger()
@@ -45,11 +54,20 @@ def lambda_handler(event, context):
     if os.environ.get('granularity') is not None:
         granularity = os.environ.get('granularity') # 1T
             
+    exchanges = None
+    if os.environ.get('exchanges') is not None:
+        exchanges = os.environ.get('exchanges').split()
+        
     params = {
         'date': date_str,
         'tickers': tickers,
-        'granularity': granularity
+        'granularity': granularity,
+        'exchanges': exchanges
     }
+    if os.environ.get('max_workers') is not None:
+        params['max_workers'] = int(os.environ.get('max_workers'))
+    if os.environ.get('features') is not None:
+        params['features'] = os.environ.get('features').lower() == 'true'
     # Log DriveUpdate parameters
     logging.info('Params: {}'.format(params))
     
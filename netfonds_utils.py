@@ -1,13 +1,42 @@
 #! /usr/bin/python3
 from io import StringIO
+import os
+import glob
 import requests as r
+import numpy as np
 import pandas as pd
 import datetime as dt
 
-def get_date_depth(date, ticker, exch='OSE'):
-    quote_r = r.get(
-        'https://www.netfonds.no/quotes/posdump.php?date={}&paper={}.{}&csv_format=csv'.format(
-            date, ticker, exch
+def get_http_session(pool_size=10):
+    """Pooled HTTP session, shared by all Netfonds requests in a run.
+    
+    # Parameters:
+        pool_size: int
+            Max number of kept-alive connections. Should match 
+            the number of workers using the session.
+    # Returns:
+        http: requests.Session
+    """
+    http = r.Session()
+    adapter = r.adapters.HTTPAdapter(
+        pool_connections=pool_size, 
+        pool_maxsize=pool_size
+    )
+    http.mount('https://', adapter)
+    http.mount('http://', adapter)
+    
+    return http
+
+
+NETFONDS_URL = 'https://www.netfonds.no'
+
+
+def get_date_depth(date, ticker, exch='OSE', http=None, base_url=NETFONDS_URL):
+    if http is None:
+        http = r
+    quote_r = http.get(
+        '{}/quotes/posdump.php?date={}&paper={}.{}&csv_format=csv'.format(
+            base_url, date, ticker, exch
         )
     )
     if quote_r.status_code != 200:
@@ -39,6 +68,110 @@ def parse_netfonds_time(date_str, format_str='%Y%m%dT%H%M%S'):
     return datetime_obj
 
 
+NETFONDS_TIME_FORMAT = '%Y%m%dT%H%M%S'
+SHEET_TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+# Byte columns of np.datetime_as_string 'YYYY-MM-DDTHH:MM:SS' kept in Netfonds format
+_NETFONDS_TIME_BYTES = [0, 1, 2, 3, 5, 6, 8, 9, 10, 11, 12, 14, 15, 17, 18]
+
+
+def parse_netfonds_times(values, format_str=NETFONDS_TIME_FORMAT):
+    """Vectorized parse of time strings into datetime64[ns].
+    Netfonds fixed-width format '%Y%m%dT%H%M%S' is parsed 
+    directly from the string bytes, other formats fall back on pandas.
+    
+    # Parameters:
+        values: array-like of str
+            Values that are already datetime64 are returned as is.
+        format_str: str
+    # Returns:
+        times: np.ndarray of datetime64[ns]
+    # Raises:
+        ValueError if a value is not a valid time of format_str,
+        or if the year is outside the datetime64[ns] range 1678-2261.
+    """
+    values = np.asarray(values)
+    if np.issubdtype(values.dtype, np.datetime64):
+        return values.astype('datetime64[ns]')
+    if format_str != NETFONDS_TIME_FORMAT:
+        return pd.to_datetime(values, format=format_str).values
+    
+    error = ValueError('Time values do not match format {}'.format(format_str))
+    
+    # Fixed-width parse: 'YYYYmmddTHHMMSS' -> (n, 15) digit matrix
+    text = values.astype(str)
+    if np.any(np.char.str_len(text) != 15):
+        raise error
+    try:
+        raw = text.astype('S15')
+    except UnicodeEncodeError:
+        raise error
+    chars = raw.view(np.uint8).reshape(-1, 15)
+    digits = chars.astype(np.int64) - ord('0')
+    date_digits = np.delete(digits, 8, axis=1)
+    if np.any(chars[:, 8] != ord('T')) or np.any((date_digits < 0) | (date_digits > 9)):
+        raise error
+    
+    def number(start, stop):
+        n = np.zeros(len(digits), dtype=np.int64)
+        for i in range(start, stop):
+            n = n * 10 + digits[:, i]
+        return n
+    
+    year, month, day = number(0, 4), number(4, 6), number(6, 8)
+    hour, minute, second = number(9, 11), number(11, 13), number(13, 15)
+    if np.any((year < 1678) | (year > 2261) | (month < 1) | (month > 12) | (day < 1)
+              | (hour > 23) | (minute > 59) | (second > 59)):
+        raise error
+    
+    months = (year - 1970).astype('datetime64[Y]').astype('datetime64[M]') \
+        + (month - 1).astype('timedelta64[M]')
+    month_days = ((months + 1).astype('datetime64[D]') 
+                  - months.astype('datetime64[D]')).astype(np.int64)
+    if np.any(day > month_days):
+        raise error
+    
+    days = months.astype('datetime64[D]') + (day - 1).astype('timedelta64[D]')
+    seconds = hour * 3600 + minute * 60 + second
+    times = days + seconds.astype('timedelta64[s]')
+    
+    return times.astype('datetime64[ns]')
+
+
+def format_sheet_times(times, format_str=SHEET_TIME_FORMAT):
+    """Vectorized format of datetimes into sheet time strings.
+    Sheet and Netfonds formats are built from fixed-width bytes,
+    other formats fall back on pandas strftime.
+    
+    # Parameters:
+        times: array-like of datetime64
+        format_str: str
+    # Returns:
+        strings: np.ndarray of str
+            NaT is formatted as ''.
+    """
+    times = np.asarray(times).astype('datetime64[s]')
+    nat = np.isnat(times)
+    if format_str not in (SHEET_TIME_FORMAT, NETFONDS_TIME_FORMAT):
+        strings = np.asarray(pd.DatetimeIndex(times).strftime(format_str), dtype=str)
+        strings[nat] = ''
+        return strings
+    
+    # 'YYYY-MM-DDTHH:MM:SS'
+    chars = np.datetime_as_string(times, unit='s').astype('S19')
+    chars = chars.view(np.uint8).reshape(-1, 19)
+    if format_str == SHEET_TIME_FORMAT:
+        chars = chars.copy()
+        chars[:, 10] = ord(' ')
+        width = 19
+    else:
+        chars = np.ascontiguousarray(chars[:, _NETFONDS_TIME_BYTES])
+        width = 15
+    strings = chars.view('S{}'.format(width)).ravel().astype('U{}'.format(width))
+    strings[nat] = ''
+    
+    return strings
+
+
 def all_duplicate_index_rows(df):
     """Get all rows with duplicate indices, including the first row of the index.
     
@@ -78,7 +211,9 @@ def add_zeroes(df):
             if time_zero_old == time_zero:
                 continue
             if time_zero < df_c.index[i-1]:
-                raise ValueError()    
+                raise ValueError(
+                    'Zero-second row {} precedes previous row {}'.format(
+                        time_zero, df_c.index[i-1]))
             df.loc[time_zero] = df_c.iloc[i-1]
             time_zero_old = time_zero
             
@@ -88,7 +223,197 @@ def add_zeroes(df):
     return df
 
 
-def ohlc_resample(df, period='1T', format_str='%Y%m%dT%H%M%S'):
+DEPTH_COLUMNS = [
+    'time', 'bid', 'bid_depth', 'bid_depth_total', 
+    'offer', 'offer_depth', 'offer_depth_total'
+]
+# Failures that reject a ticker before upload. 
+# Duplicate seconds are common in posdump data and only reported.
+REJECT_REASONS = (
+    'fetch_failed', 'empty', 'missing_columns', 'bad_time_format',
+    'unsorted_time', 'negative_depth'
+)
+# Crossed quotes are common around auctions, only a larger 
+# fraction of crossed rows rejects a ticker
+MAX_CROSSED_FRACTION = 0.01
+# Transient failures worth retrying
+RETRY_REASONS = ('fetch_failed',)
+
+
+def rejecting_reasons(report, n_rows, max_crossed_fraction=MAX_CROSSED_FRACTION):
+    """Reasons of a validate_depth report that reject the ticker.
+    
+    # Parameters:
+        report: dict
+            Output of validate_depth.
+        n_rows: int
+            Number of validated rows.
+        max_crossed_fraction: float
+            Max fraction of crossed_book rows that is only reported.
+    # Returns:
+        reasons: list of str
+    """
+    reasons = [reason for reason in report if reason in REJECT_REASONS]
+    if report.get('crossed_book', 0) > max_crossed_fraction * n_rows:
+        reasons.append('crossed_book')
+        
+    return sorted(reasons)
+
+
+class DataQualityError(ValueError):
+    """Posdump data of a ticker failed validation.
+    
+    # Attributes:
+        paper: str
+            Ex. 'DNB.OSE'
+        report: dict
+            {reason: number of failing rows}, see validate_depth.
+        reasons: list of str
+            Rejecting reasons of report, see rejecting_reasons.
+        retryable: boolean
+            True if all rejecting reasons may be transient.
+    """
+    def __init__(self, paper, report, reasons):
+        self.paper = paper
+        self.report = report
+        self.reasons = sorted(reasons)
+        self.retryable = all(r in RETRY_REASONS for r in self.reasons)
+        super(DataQualityError, self).__init__(
+            '{}: Data quality check failed: {}'.format(paper, report))
+
+
+def validate_depth(df):
+    """Vectorized data quality checks of netfonds posdump data.
+    
+    # Parameters:
+        df: pd.DataFrame or None
+            Output of get_date_depth, with 'time' parsed to datetime64.
+    # Returns:
+        report: dict
+            {reason: number of failing rows}. Empty if all checks pass.
+            Reasons:
+                fetch_failed: no data, ex. bad status code
+                empty: no rows
+                missing_columns: number of missing posdump columns
+                bad_time_format: 'time' could not be parsed
+                unsorted_time: rows earlier than the previous row
+                duplicate_time: rows with the same time as the previous row
+                crossed_book: rows with offer < bid
+                negative_depth: rows with a negative depth
+    """
+    if df is None:
+        return {'fetch_failed': 1}
+    if not len(df):
+        return {'empty': 1}
+    missing = [col for col in DEPTH_COLUMNS if col not in df.columns]
+    if missing:
+        return {'missing_columns': len(missing)}
+    if not np.issubdtype(df['time'].dtype, np.datetime64):
+        return {'bad_time_format': len(df)}
+    
+    times = df['time'].values.astype(np.int64)
+    step = np.diff(times)
+    bid = df['bid'].values
+    offer = df['offer'].values
+    depths = df[[
+        'bid_depth', 'bid_depth_total', 'offer_depth', 'offer_depth_total'
+    ]].values
+    
+    counts = {
+        'unsorted_time': np.count_nonzero(step < 0),
+        'duplicate_time': np.count_nonzero(step == 0),
+        # Zero quotes mean an empty side of the book
+        'crossed_book': np.count_nonzero((offer < bid) & (bid > 0) & (offer > 0)),
+        'negative_depth': np.count_nonzero((depths < 0).any(axis=1))
+    }
+    report = {reason: int(n) for reason, n in counts.items() if n}
+    
+    return report
+
+
+FEATURE_KEYS = [
+    'mid_open', 'mid_high', 'mid_low', 'mid_close',
+    'bid_vwap', 'offer_vwap', 'microprice',
+    'imbalance', 'spread_twa'
+]
+
+
+def resample_features(df, period='1T'):
+    """Order book features per bar. Expects the time indexed, 
+    zero-filled df of ohlc_resample. Rows with a zero quote 
+    (empty side of the book) are left out of all features. Bars 
+    without quoted rows carry all features forward from the previous
+    bar, as do bid_vwap/offer_vwap of bars without depth on that side.
+    Features are 0 only before the first quote of the day.
+    
+    # Parameters:
+        df: pd.DataFrame
+        period: str
+    # Returns:
+        features: pd.DataFrame
+            Columns:
+                mid_open, mid_high, mid_low, mid_close: OHLC of (bid + offer) / 2
+                bid_vwap, offer_vwap: prices weighted by bid/offer depth
+                microprice: last price weighted by opposite best-level depth
+                    (bid_depth/offer_depth)
+                imbalance: time-weighted (bid - offer) / (bid + offer) total depth
+                spread_twa: time-weighted spread
+    """
+    bid = df['bid']
+    offer = df['offer']
+    quoted = (bid > 0) & (offer > 0)
+    
+    mid_rs = ((bid + offer) / 2).where(quoted).resample(period).ohlc()
+    mid_rs['close'] = mid_rs['close'].ffill()
+    mid_rs = mid_rs.apply(lambda col: col.fillna(mid_rs['close']))
+    
+    # Depth-weighted prices, added zero rows have zero depth
+    bid_weight = df['bid_depth'].where(bid > 0, 0)
+    offer_weight = df['offer_depth'].where(offer > 0, 0)
+    bid_vwap_rs = ((bid * bid_weight).resample(period).sum() 
+                   / bid_weight.resample(period).sum()).ffill()
+    offer_vwap_rs = ((offer * offer_weight).resample(period).sum() 
+                     / offer_weight.resample(period).sum()).ffill()
+    
+    microprice = (
+        bid * df['offer_depth'] + offer * df['bid_depth']
+    ) / (df['bid_depth'] + df['offer_depth'])
+    microprice_rs = microprice.where(quoted).resample(period).last().ffill()
+    
+    depth_total = df['bid_depth_total'] + df['offer_depth_total']
+    imbalance = ((df['bid_depth_total'] - df['offer_depth_total']) / depth_total).where(quoted)
+    spread = (offer - bid).where(quoted)
+    
+    # Seconds each row is in effect, until next row or bar end
+    times = df.index.values
+    bar_end = (df.index.floor(period) + pd.tseries.frequencies.to_offset(period)).values
+    next_time = np.append(times[1:], bar_end[-1:])
+    duration = pd.Series(
+        (np.minimum(next_time, bar_end) - times) / np.timedelta64(1, 's'), 
+        index=df.index
+    )
+    
+    def time_weighted(values):
+        weight = duration.where(values.notna(), 0)
+        return ((values * weight).resample(period).sum() 
+                / weight.resample(period).sum()).ffill()
+    
+    features = pd.concat(
+        [
+            mid_rs, bid_vwap_rs, offer_vwap_rs, microprice_rs, 
+            time_weighted(imbalance), time_weighted(spread)
+        ], 
+        axis=1
+    )
+    features.columns = FEATURE_KEYS
+    # Bars without any rows stay empty, and are dropped by ohlc_resample
+    has_rows = bid.resample(period).count() > 0
+    features = features.where(has_rows, axis=0)
+    
+    return features
+
+
+def ohlc_resample(df, period='1T', format_str='%Y%m%dT%H%M%S', features=False):
     """Resample netfonds posdump data. Made for 1T but should work for more.
     
     # Parameters:
@@ -99,12 +424,14 @@ def ohlc_resample(df, period='1T', format_str='%Y%m%dT%H%M%S'):
         format_str: str
             Datetime format. Read more about datetime formats here:
             https://docs.python.org/2/library/datetime.html#strftime-and-strptime-behavior
+        features: boolean
+            Add order book features of resample_features in the same pass.
     # Returns:
         df_concat: pd.DataFrame
             Resampled and processed df
     """
     # Parse datetime index
-    df['time'] = pd.to_datetime(df['time'], format=format_str)
+    df['time'] = parse_netfonds_times(df['time'], format_str)
     df.index = pd.DatetimeIndex(df['time'])
     df['time'] = df.index
     
@@ -132,13 +459,13 @@ def ohlc_resample(df, period='1T', format_str='%Y%m%dT%H%M%S'):
     # Drop cell if sum is zero, zero cells are irrelevant in this case and equivalent to nan
     offer_depth_rs = offer_depth_rs[offer_depth_rs != 0]
 
-    df_concat = pd.concat(
-        [
-            bid_rs, bid_depth_rs, bid_depth_total_rs,
-            offer_depth_rs, offer_depth_total_rs, spread_rs
-        ], 
-        axis=1, 
-    )
+    rs_list = [
+        bid_rs, bid_depth_rs, bid_depth_total_rs,
+        offer_depth_rs, offer_depth_total_rs, spread_rs
+    ]
+    if features:
+        rs_list.append(resample_features(df, period))
+    df_concat = pd.concat(rs_list, axis=1)
     # If all columns in a row are nan, drop row
     df_concat = df_concat.dropna(how='all')
     # Rare nan cases are replaced with 0
@@ -155,6 +482,8 @@ def ohlc_resample(df, period='1T', format_str='%Y%m%dT%H%M%S'):
         'offer_depth_total_low', 'offer_depth_total_close',
         'spread'
     ]
+    if features:
+        keys += FEATURE_KEYS
     # Rename df
     df_concat.columns = keys
 
@@ -163,4 +492,63 @@ def ohlc_resample(df, period='1T', format_str='%Y%m%dT%H%M%S'):
 
 def get_assets(tickerfile='assets/OSE_tickers.csv', sep=';'):
     tickers = pd.read_csv(tickerfile, sep=sep)
-    return list(tickers['paper'])
\ No newline at end of file
+    return list(tickers['paper'])
+
+
+def get_ticker_registry(tickerdir='assets', exchanges=None, sep=';'):
+    """Load ticker files of all exchanges into one registry.
+    Ticker files are named '<EXCHANGE>_tickers.csv', ex. 'OSE_tickers.csv'.
+    
+    # Parameters:
+        tickerdir: str
+            Directory of ticker files.
+        exchanges: list of str
+            Only load these exchanges. If not passed, load all ticker files.
+        sep: str
+    # Returns:
+        registry: dict
+            {exchange: [ticker1, ..., tickerN]}
+    """
+    registry = {}
+    for tickerfile in sorted(glob.glob(os.path.join(tickerdir, '*_tickers.csv'))):
+        exchange = os.path.basename(tickerfile)[:-len('_tickers.csv')]
+        if exchanges is not None and exchange not in exchanges:
+            continue
+        registry[exchange] = get_assets(tickerfile=tickerfile, sep=sep)
+        
+    if exchanges is not None:
+        missing = set(exchanges) - set(registry)
+        if missing:
+            raise ValueError(
+                'No ticker file for exchange(s): {}'.format(sorted(missing)))
+    
+    return registry
+
+
+def paper_name(ticker, exchange):
+    """Netfonds paper name, ex. 'DNB.OSE'.
+    """
+    return '{}.{}'.format(ticker, exchange)
+
+
+# Exchange of all sheets created before multi-exchange support
+LEGACY_EXCHANGE = 'OSE'
+
+
+def sheet_prefix(ticker, exchange):
+    """Sheet name prefix of a ticker. Legacy exchange sheets keep 
+    the bare ticker, ex. 'DNB', other exchanges use the paper name.
+    """
+    if exchange == LEGACY_EXCHANGE:
+        return ticker
+    return paper_name(ticker, exchange)
+
+
+def split_paper(paper, default_exchange='OSE'):
+    """Split paper name into (ticker, exchange).
+    'DNB.OSE' -> ('DNB', 'OSE'), 'DNB' -> ('DNB', default_exchange)
+    """
+    if '.' in paper:
+        ticker, exchange = paper.rsplit('.', 1)
+        return ticker, exchange
+    return paper, default_exchange
\ No newline at end of file
@@ -1,8 +1,9 @@
 from kvant_google_api import *
 from googleapiclient.discovery import build
 import gspread
-import pandas as pd
 import time
+import argparse
+import netfonds_utils as nu
 
 
 # Authorization scheme
@@ -20,7 +21,15 @@ def authorize():
     return gc, drive
 
 
-def main():
+def main(features=False):
+    """Create minute sheets of all registry tickers and populate headers.
+    
+    # Parameters:
+        features: boolean
+            Include order book feature columns in the header.
+            Must match DriveUpdate(features=...).
+            Existing headers of sheets without data are extended.
+    """
     # Data 04 folder ID
     data_folder = '1mTf4HKFsGpk2bWvCVtmNestZp9owKuG-' # Data 04
     data_folder = '1dOOIYGn1wq4hz6O4mnbCIOCMacIWSXt5' # Posdump
@@ -29,8 +38,12 @@ def main():
     # Authorization scheme
     gc, drive = authorize()
     
-    # Import all tickers
-    ticker_list = pd.read_csv('../data/OSE_tickers.csv', sep=';')['paper']
+    # Import all tickers of all exchanges
+    registry = nu.get_ticker_registry(tickerdir='assets')
+    prefix_list = [
+        nu.sheet_prefix(ticker, exchange) 
+        for exchange in registry for ticker in registry[exchange]
+    ]
 
     """# Get all file metadata from Data folder
     files = get_folder_files(drive, data_folder)['files']
@@ -38,20 +51,20 @@ def main():
     # > Get more than 100 results (NextPage or equiv)
     filenames = [file['name'] for file in files]
     """
-    #filenames = ['{}_posdump'.format(ticker) for ticker in ticker_list]
+    #filenames = ['{}_posdump'.format(prefix) for prefix in prefix_list]
     filenames = []
     
     # Request burst timer
     old_time = time.time()
     
     # Create and populate tick sheet headers
-    for ticker in ticker_list:
+    for prefix in prefix_list:
         # Prevent Google API rate limiting
         while time.time() - old_time < 0.6: # Max 5 requests/sec
             time.sleep(0.1)
         old_time = time.time()
         
-        sheet_name = '{}_minute'.format(ticker)
+        sheet_name = '{}_minute'.format(prefix)
         # Check if sheet file sheet_name already exists
         if sheet_name not in filenames:
             create_file(drive, sheet_name, data_folder)
@@ -66,13 +79,25 @@ def main():
         # Get last cell in col 1, most likely col 1 is 'time'
         lfc = last_filled_cell(wks)
         if lfc == '':
-            populate_sheet_header(sps=sps, ohlc=True)
+            populate_sheet_header(sps=sps, ohlc=True, features=features)
             print(sheet_name, ': Header successfully populated', sep='')
         elif lfc == 'time':
-            print(sheet_name, ': Header already populated', sep='')
+            # Header only, extend it with feature columns if missing
+            header = sheet_header(wks)
+            keys = sheet_header_keys(ohlc=True, features=features)
+            if features and header != keys:
+                populate_sheet_header(sps=sps, ohlc=True, features=features)
+                print(sheet_name, ': Header extended from {} to {} columns'.format(
+                    len(header), len(keys)), sep='')
+            else:
+                print(sheet_name, ': Header already populated', sep='')
         else:
             print(sheet_name, ': Non-empty sheet. Last filled cell of col1: ', lfc)
 
             
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Populate headers of all minute sheets.')
+    parser.add_argument('--features', action='store_true',
+                        help='Include order book feature columns.')
+    args = parser.parse_args()
+    main(features=args.features)
\ No newline at end of file
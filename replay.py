@@ -0,0 +1,414 @@
+#! /usr/bin/python3
+"""Offline replay harness for DriveUpdate.
+
+Serves recorded Netfonds posdump files from a local HTTP server and
+replaces the Google Sheets and Drive APIs with an in-memory backend
+with latency, quota and error injection.
+
+Recordings are stored as '<recordings>/<date>/<ticker>.<exchange>.csv'.
+
+# Usage:
+    Record posdumps of all registry tickers:
+        python replay.py --record --date 20190130
+    Replay with different worker counts:
+        python replay.py --date 20190130 --workers 1 4 8
+"""
+import os
+import time
+import random
+import logging
+import argparse
+import threading
+import requests as r
+import netfonds_utils as nu
+import kvant_google_api as kga
+
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from touch import Session, DriveUpdate
+
+
+def recording_path(recordings, date, paper):
+    return os.path.join(recordings, date, '{}.csv'.format(paper))
+
+
+def record(date, papers, recordings='recordings'):
+    """Download posdumps from Netfonds into recordings.
+
+    # Parameters:
+        date: str
+        papers: list of str
+            Ex. ['DNB.OSE', 'EQNR.OSE']
+        recordings: str
+            Recordings directory.
+    # Returns:
+        recorded: list of str
+            Papers with a recorded posdump.
+    """
+    os.makedirs(os.path.join(recordings, date), exist_ok=True)
+    http = nu.get_http_session(pool_size=1)
+    recorded = []
+    for paper in papers:
+        ticker, exchange = nu.split_paper(paper)
+        quote_r = http.get(
+            '{}/quotes/posdump.php?date={}&paper={}.{}&csv_format=csv'.format(
+                nu.NETFONDS_URL, date, ticker, exchange
+            )
+        )
+        if quote_r.status_code != 200:
+            logging.warning('{}: Bad status code: {}'.format(paper, quote_r.status_code))
+            continue
+        with open(recording_path(recordings, date, paper), 'wb') as f:
+            f.write(quote_r.content)
+        recorded.append(paper)
+
+    return recorded
+
+
+def recorded_papers(date, recordings='recordings'):
+    """Papers with a recorded posdump at date.
+    """
+    files = os.listdir(os.path.join(recordings, date))
+    return sorted(f[:-len('.csv')] for f in files if f.endswith('.csv'))
+
+
+class NetfondsReplayServer(object):
+    """Local stand-in for Netfonds posdump.php, serving recordings.
+    Unrecorded (date, paper) pairs get status 404.
+
+    # Parameters:
+        recordings: str
+            Recordings directory.
+        latency: float
+            Seconds added to every response.
+        port: int
+            0 picks a free port.
+    """
+    def __init__(self, recordings='recordings', latency=0., port=0):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                query = parse_qs(url.query)
+                try:
+                    path = recording_path(
+                        server.recordings, query['date'][0], query['paper'][0])
+                except KeyError:
+                    path = None
+                time.sleep(server.latency)
+
+                if url.path != '/quotes/posdump.php' or path is None \
+                        or not os.path.exists(path):
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                with open(path, 'rb') as f:
+                    body = f.read()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/csv; charset=ISO-8859-1')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.recordings = recordings
+        self.latency = latency
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.httpd.daemon_threads = True
+        self.url = 'http://127.0.0.1:{}'.format(self.httpd.server_port)
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+class FakeAPIError(Exception):
+    """Injected API error. Mimics gspread.exceptions.APIError,
+    see kga.api_error_code.
+    """
+    def __init__(self, status_code, message):
+        super(FakeAPIError, self).__init__(
+            {'error': {'code': status_code, 'message': message}})
+        self.response = r.Response()
+        self.response.status_code = status_code
+
+
+class FakeBackend(object):
+    """In-memory Sheets and Drive backend.
+
+    # Parameters:
+        latency: float
+            Seconds added to every request.
+        quota: int
+            Max requests per quota_window seconds, then 429 errors.
+            None for no quota.
+        quota_window: float
+        error_rate: float
+            Probability of a 503 error per request.
+        header: list of str
+            Header row of new sheets. Sheets are created on first open.
+        seed: int
+    """
+    def __init__(self, latency=0.05, quota=None, quota_window=100.,
+                 error_rate=0., header=None, seed=0):
+        self.latency = latency
+        self.quota = quota
+        self.quota_window = quota_window
+        self.error_rate = error_rate
+        self.header = header
+        self.sheets = {}
+        self.counts = {'requests': 0, '429': 0, '503': 0}
+        self._request_times = []
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def request(self):
+        """Account for one API request, with latency and injected errors.
+        """
+        time.sleep(self.latency)
+        with self._lock:
+            now = time.time()
+            self.counts['requests'] += 1
+            if self.quota is not None:
+                self._request_times = [
+                    t for t in self._request_times if now - t < self.quota_window
+                ]
+                if len(self._request_times) >= self.quota:
+                    self.counts['429'] += 1
+                    raise FakeAPIError(429, 'Quota exceeded')
+                self._request_times.append(now)
+            if self._random.random() < self.error_rate:
+                self.counts['503'] += 1
+                raise FakeAPIError(503, 'Service unavailable')
+
+    def rows(self, sheet_name):
+        with self._lock:
+            if sheet_name not in self.sheets:
+                self.sheets[sheet_name] = [] if self.header is None else [list(self.header)]
+            return self.sheets[sheet_name]
+
+
+class FakeCell(object):
+    def __init__(self, value):
+        self.value = value
+
+
+class FakeWorksheet(object):
+    def __init__(self, backend, sheet_name):
+        self.backend = backend
+        self.sheet_name = sheet_name
+
+    def col_values(self, col):
+        self.backend.request()
+        rows = self.backend.rows(self.sheet_name)
+        return [str(row[col - 1]) if len(row) >= col else '' for row in rows]
+
+    def row_values(self, row):
+        self.backend.request()
+        rows = self.backend.rows(self.sheet_name)
+        return [str(value) for value in rows[row - 1]] if len(rows) >= row else []
+
+    def cell(self, row, col):
+        self.backend.request()
+        return FakeCell(str(self.backend.rows(self.sheet_name)[row - 1][col - 1]))
+
+
+class FakeSpreadsheet(object):
+    def __init__(self, backend, sheet_name):
+        self.backend = backend
+        self.sheet_name = sheet_name
+
+    @property
+    def sheet1(self):
+        self.backend.request()
+        return FakeWorksheet(self.backend, self.sheet_name)
+
+    def values_append(self, range, body, params=None):
+        self.backend.request()
+        values = body['values']
+        rows = self.backend.rows(self.sheet_name)
+        with self.backend._lock:
+            rows.extend(values)
+        return {
+            'updates': {
+                'updatedRows': len(values),
+                'updatedCells': sum(len(row) for row in values)
+            }
+        }
+
+    def values_update(self, range, body, params=None):
+        self.backend.request()
+        rows = self.backend.rows(self.sheet_name)
+        with self.backend._lock:
+            rows[:len(body['values'])] = body['values']
+        return {'updatedRows': len(body['values'])}
+
+
+class FakeSheetsClient(object):
+    """Stand-in for the gspread client.
+    """
+    def __init__(self, backend):
+        self.backend = backend
+
+    def open(self, sheet_name):
+        self.backend.request()
+        return FakeSpreadsheet(self.backend, sheet_name)
+
+
+class _FakeRequest(object):
+    def __init__(self, backend, func):
+        self.backend = backend
+        self.func = func
+
+    def execute(self):
+        self.backend.request()
+        return self.func()
+
+
+class FakeDriveClient(object):
+    """Stand-in for the Drive v3 service, files().list/create only.
+    """
+    def __init__(self, backend):
+        self.backend = backend
+
+    def files(self):
+        return self
+
+    def list(self, q=None):
+        return _FakeRequest(self.backend, lambda: {
+            'files': [{'name': name} for name in sorted(self.backend.sheets)]
+        })
+
+    def create(self, body):
+        return _FakeRequest(self.backend, lambda: {
+            'name': body['name'], 'rows': len(self.backend.rows(body['name']))
+        })
+
+
+class ReplaySession(Session):
+    """Session against a FakeBackend. Authorization is local,
+    tokens expire after token_lifetime seconds.
+    """
+    def __init__(self, backend, token_lifetime=3600, **kwargs):
+        super(ReplaySession, self).__init__(**kwargs)
+        self.backend = backend
+        self.token_lifetime = token_lifetime
+        self.expires_at = None
+
+    def authorize(self, filename=None):
+        self.token = 'replay-{}'.format(time.time())
+        self.expires_at = time.time() + self.token_lifetime
+        self.sheets = FakeSheetsClient(self.backend)
+        self.drive = FakeDriveClient(self.backend)
+        self.cache.invalidate()
+
+    def valid(self, expiry_threshold=1000):
+        return self.expires_at - time.time() >= expiry_threshold
+
+
+def replay_run(date, papers, server, workers, backend_params=None, **params):
+    """Run DriveUpdate offline once.
+
+    # Parameters:
+        date: str
+        papers: list of str
+        server: NetfondsReplayServer
+        workers: int
+        backend_params: dict
+            FakeBackend parameters.
+        params:
+            Other DriveUpdate parameters.
+    # Returns:
+        result: dict
+            Wall time, DriveUpdate summary and backend counters.
+    """
+    backend = FakeBackend(**(backend_params or {}))
+    session = ReplaySession(backend)
+    session.authorize()
+    du = DriveUpdate(
+        date=date, tickers=papers, max_workers=workers,
+        session=session, netfonds_url=server.url, **params
+    )
+    start = time.time()
+    du.run()
+    if len(du.retry_list):
+        du.retry()
+
+    return {
+        'workers': workers,
+        'seconds': round(time.time() - start, 2),
+        'summary': du.summary(),
+        'backend': dict(backend.counts)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline replay of DriveUpdate.')
+    parser.add_argument('--date', required=True)
+    parser.add_argument('--recordings', default='recordings')
+    parser.add_argument('--record', action='store_true',
+                        help='Download posdumps of all registry tickers and exit.')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 4])
+    parser.add_argument('--granularity', default='1T')
+    parser.add_argument('--ticks', action='store_true',
+                        help='Upload ticks instead of resampled data.')
+    parser.add_argument('--features', action='store_true',
+                        help='Add order book features to resampled data.')
+    parser.add_argument('--netfonds-latency', type=float, default=0.05)
+    parser.add_argument('--sheets-latency', type=float, default=0.1)
+    parser.add_argument('--quota', type=int, default=None,
+                        help='Max Sheets requests per 100 seconds.')
+    parser.add_argument('--error-rate', type=float, default=0.)
+    parser.add_argument('--netfonds-interval', type=float, default=0.)
+    parser.add_argument('--sheets-interval', type=float, default=0.)
+    args = parser.parse_args()
+
+    if args.record:
+        registry = nu.get_ticker_registry()
+        papers = [
+            nu.paper_name(ticker, exchange)
+            for exchange in registry for ticker in registry[exchange]
+        ]
+        recorded = record(args.date, papers, args.recordings)
+        print('Recorded {} of {} papers.'.format(len(recorded), len(papers)))
+        return
+
+    papers = recorded_papers(args.date, args.recordings)
+    backend_params = {
+        'latency': args.sheets_latency,
+        'quota': args.quota,
+        'error_rate': args.error_rate,
+        'header': kga.sheet_header_keys(ohlc=not args.ticks, features=args.features)
+    }
+    results = []
+    with NetfondsReplayServer(args.recordings, latency=args.netfonds_latency) as server:
+        for workers in args.workers:
+            results.append(replay_run(
+                args.date, papers, server, workers, backend_params,
+                granularity=None if args.ticks else args.granularity,
+                features=args.features,
+                netfonds_interval=args.netfonds_interval,
+                sheets_interval=args.sheets_interval
+            ))
+
+    for result in results:
+        print(result)
+
+
+if __name__ == '__main__':
+    main()
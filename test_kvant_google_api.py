@@ -0,0 +1,113 @@
+import json
+import numpy as np
+import pandas as pd
+import pytest
+import kvant_google_api as kga
+
+
+def chunk_frame(n_rows=2500, seed=0):
+    """Rows of varying json size, with one oversized row.
+    """
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({
+        'time': ['20190130T09{:04d}'.format(i) for i in range(n_rows)],
+        'price': rng.random(n_rows).round(3),
+        'note': ['x' * int(n) for n in rng.integers(0, 200, n_rows)]
+    })
+    df.loc[n_rows // 2, 'note'] = 'x' * 5000
+    return df
+
+
+@pytest.mark.parametrize('start_row', [0, 1, 1234])
+@pytest.mark.parametrize('chunk_rows, chunk_bytes, block_rows', [
+    (5000, 2*1024**2, 1000), # Bounded by rows, single chunk
+    (100, 2*1024**2, 1000),
+    (100, 4096, 1000), # Bounded by bytes, oversized row alone
+    (7, 1000, 3), # Chunks cross blocks
+    (1, 10, 1000),
+])
+def test_iter_row_chunks(start_row, chunk_rows, chunk_bytes, block_rows):
+    df = chunk_frame()
+    chunks = list(kga.iter_row_chunks(
+        df, start_row=start_row, chunk_rows=chunk_rows,
+        chunk_bytes=chunk_bytes, block_rows=block_rows))
+
+    offset = start_row
+    for chunk_offset, rows in chunks:
+        assert chunk_offset == offset
+        assert 0 < len(rows) <= chunk_rows
+        n_bytes = sum(len(json.dumps(row)) + 1 for row in rows)
+        assert n_bytes <= chunk_bytes or len(rows) == 1
+        offset += len(rows)
+
+    assert [row for _, rows in chunks for row in rows] \
+        == df.iloc[start_row:].values.tolist()
+
+
+def test_iter_row_chunks_past_end():
+    df = chunk_frame(10)
+    assert list(kga.iter_row_chunks(df, start_row=10)) == []
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000.
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(kga.time, 'time', clock.time)
+    return clock
+
+
+def test_ttl_cache_expiry(clock):
+    cache = kga.TTLCache(ttl=10)
+    calls = []
+    func = lambda: calls.append(1) or len(calls)
+    assert cache.get('a', func) == 1
+    clock.now += 9
+    assert cache.get('a', func) == 1
+    clock.now += 1
+    assert cache.get('a', func) == 2
+    assert cache.stats() == {'hits': 1, 'misses': 2, 'size': 1}
+
+
+def test_ttl_cache_lru_eviction(clock):
+    cache = kga.TTLCache(maxsize=2)
+    cache.get('a', lambda: 'a')
+    cache.get('b', lambda: 'b')
+    # Use a, b is least recently used
+    assert cache.get('a', lambda: 'a2') == 'a'
+    cache.get('c', lambda: 'c')
+    assert cache.stats() == {'hits': 1, 'misses': 3, 'size': 2}
+    assert cache.get('a', lambda: 'a2') == 'a'
+    assert cache.get('b', lambda: 'b2') == 'b2'
+    assert cache.stats() == {'hits': 2, 'misses': 4, 'size': 2}
+
+
+def test_ttl_cache_does_not_cache_errors(clock):
+    cache = kga.TTLCache()
+
+    def fail():
+        raise RuntimeError('API error')
+
+    with pytest.raises(RuntimeError):
+        cache.get('a', fail)
+    assert cache.stats() == {'hits': 0, 'misses': 1, 'size': 0}
+    assert cache.get('a', lambda: 'a') == 'a'
+    assert cache.get('a', fail) == 'a'
+    assert cache.stats() == {'hits': 1, 'misses': 2, 'size': 1}
+
+
+def test_ttl_cache_invalidate(clock):
+    cache = kga.TTLCache()
+    cache.get('a', lambda: 'a')
+    cache.get('b', lambda: 'b')
+    cache.invalidate('a')
+    assert cache.get('a', lambda: 'a2') == 'a2'
+    cache.invalidate()
+    assert cache.stats()['size'] == 0
@@ -0,0 +1,221 @@
+import datetime as dt
+import numpy as np
+import pandas as pd
+import pytest
+import netfonds_utils as nu
+
+
+VALID_TIMES = [
+    '20190130T090000',
+    '20191231T235959',
+    '20200229T120501', # Leap day
+    '19700101T000000',
+    '16780101T000000',
+    '22611231T235959',
+]
+INVALID_TIMES = [
+    '20190230T090000', # Day out of month
+    '21000229T000000', # Not a leap year
+    '20191301T090000', # Month 13
+    '20190100T090000', # Day 0
+    '20190130T250000', # Hour 25
+    '20190130T096000', # Minute 60
+    '20190130T090060', # Second 60
+    '00000101T000000', # Year 0
+    '20190130 090000',
+    '20190130T09000a',
+    '2019-1-30T09000',
+    '20190130T0900001', # Too long
+]
+
+
+def test_parse_matches_strptime():
+    times = nu.parse_netfonds_times(VALID_TIMES)
+    expected = [
+        np.datetime64(dt.datetime.strptime(s, nu.NETFONDS_TIME_FORMAT), 'ns')
+        for s in VALID_TIMES
+    ]
+    assert list(times) == expected
+
+
+@pytest.mark.parametrize('time_str', INVALID_TIMES)
+def test_parse_rejects_like_strptime(time_str):
+    with pytest.raises(ValueError):
+        dt.datetime.strptime(time_str, nu.NETFONDS_TIME_FORMAT)
+    with pytest.raises(ValueError):
+        nu.parse_netfonds_times([time_str])
+    # One bad value rejects the whole array
+    with pytest.raises(ValueError):
+        nu.parse_netfonds_times(VALID_TIMES + [time_str])
+
+
+@pytest.mark.parametrize('time_str', [
+    '2019013T090000', # strptime reads '%d' from one digit
+    '20190130T09000', # strptime reads '%S' from one digit
+    '00010101T000000', # Outside datetime64[ns] range
+    '99991231T235959',
+])
+def test_parse_stricter_than_strptime(time_str):
+    dt.datetime.strptime(time_str, nu.NETFONDS_TIME_FORMAT)
+    with pytest.raises(ValueError):
+        nu.parse_netfonds_times([time_str])
+
+
+def test_format_round_trip():
+    times = nu.parse_netfonds_times(VALID_TIMES)
+    strings = nu.format_sheet_times(times, nu.NETFONDS_TIME_FORMAT)
+    assert list(strings) == VALID_TIMES
+    sheet_strings = nu.format_sheet_times(times)
+    assert list(sheet_strings) == [
+        dt.datetime.strptime(s, nu.NETFONDS_TIME_FORMAT).strftime(nu.SHEET_TIME_FORMAT)
+        for s in VALID_TIMES
+    ]
+
+
+@pytest.mark.parametrize('format_str', [
+    nu.SHEET_TIME_FORMAT, nu.NETFONDS_TIME_FORMAT, '%d/%m/%Y'
+])
+def test_format_nat_is_empty(format_str):
+    times = np.array(['2019-01-30T09:00:00', 'NaT'], dtype='datetime64[ns]')
+    strings = nu.format_sheet_times(times, format_str)
+    assert strings[0] != ''
+    assert strings[1] == ''
+
+
+def test_crossed_book_rejects_only_above_fraction():
+    report = {'crossed_book': 1, 'duplicate_time': 50}
+    assert nu.rejecting_reasons(report, 2000) == []
+    assert nu.rejecting_reasons(report, 2000, max_crossed_fraction=0.) == ['crossed_book']
+    report = {'crossed_book': 100, 'negative_depth': 1}
+    assert nu.rejecting_reasons(report, 2000) == ['crossed_book', 'negative_depth']
+
+
+def depth_frame():
+    return pd.DataFrame({
+        'time': pd.to_datetime([
+            '2019-01-30 09:00:00', '2019-01-30 09:00:01', '2019-01-30 09:00:02'
+        ]),
+        'bid': [100., 100.5, 0.],
+        'bid_depth': [10, 20, 0],
+        'bid_depth_total': [50, 60, 0],
+        'offer': [101., 101.5, 102.],
+        'offer_depth': [5, 15, 25],
+        'offer_depth_total': [40, 45, 55]
+    })
+
+
+def swap_rows(df):
+    return df.iloc[[1, 0, 2]].reset_index(drop=True)
+
+
+def repeat_second(df):
+    df.loc[1, 'time'] = df.loc[0, 'time']
+    return df
+
+
+def cross_book(df):
+    # Row 2 has an empty bid side and is not crossed
+    df.loc[0, 'offer'] = 99.
+    df.loc[2, 'offer'] = 0.
+    return df
+
+
+def negative_depth(df):
+    df.loc[1, 'offer_depth_total'] = -1
+    return df
+
+
+@pytest.mark.parametrize('make_df, expected', [
+    (lambda: depth_frame(), {}),
+    (lambda: None, {'fetch_failed': 1}),
+    (lambda: depth_frame().iloc[:0], {'empty': 1}),
+    (lambda: depth_frame().drop(columns='bid_depth'), {'missing_columns': 1}),
+    (lambda: depth_frame().assign(time=lambda df: df['time'].dt.strftime(
+        nu.NETFONDS_TIME_FORMAT)), {'bad_time_format': 3}),
+    (lambda: swap_rows(depth_frame()), {'unsorted_time': 1}),
+    (lambda: repeat_second(depth_frame()), {'duplicate_time': 1}),
+    (lambda: cross_book(depth_frame()), {'crossed_book': 1}),
+    (lambda: negative_depth(depth_frame()), {'negative_depth': 1}),
+])
+def test_validate_depth(make_df, expected):
+    assert nu.validate_depth(make_df()) == expected
+
+
+def feature_frame():
+    """Time indexed depth rows, as passed to resample_features.
+    """
+    times = pd.to_datetime([
+        '2019-01-30 09:00:00', '2019-01-30 09:00:30', # Quoted
+        '2019-01-30 09:01:00', # Empty bid side
+        '2019-01-30 09:02:00', # Quoted
+        '2019-01-30 09:04:00', # After a bar without rows
+    ])
+    return pd.DataFrame({
+        'bid': [100., 101., 0., 102., 102.],
+        'bid_depth': [10, 20, 0, 10, 10],
+        'bid_depth_total': [100, 200, 0, 100, 100],
+        'offer': [102., 102., 103., 103., 103.],
+        'offer_depth': [30, 20, 5, 10, 10],
+        'offer_depth_total': [300, 200, 50, 100, 100],
+    }, index=times)
+
+
+def test_resample_features():
+    features = nu.resample_features(feature_frame())
+    assert list(features.columns) == nu.FEATURE_KEYS
+    first = features.iloc[0]
+    assert list(first[['mid_open', 'mid_high', 'mid_low', 'mid_close']]) \
+        == [101., 101.5, 101., 101.5]
+    assert first['bid_vwap'] == pytest.approx((100*10 + 101*20) / 30)
+    assert first['offer_vwap'] == 102.
+    assert first['microprice'] == (101*20 + 102*20) / 40
+    # Rows in effect for 30 seconds each
+    assert first['imbalance'] == pytest.approx((-200/400 + 0/400) / 2)
+    assert first['spread_twa'] == pytest.approx((2. + 1.) / 2)
+
+    third = features.iloc[2]
+    assert list(third[['mid_open', 'mid_close', 'microprice']]) == [102.5]*3
+    assert third['spread_twa'] == 1.
+    assert third['imbalance'] == 0.
+
+
+def test_resample_features_zero_quotes_carry_forward():
+    features = nu.resample_features(feature_frame())
+    first, zero_quote = features.iloc[0], features.iloc[1]
+    # Flat mid bar at the previous close
+    for key in ['mid_open', 'mid_high', 'mid_low', 'mid_close']:
+        assert zero_quote[key] == first['mid_close'], key
+    for key in ['bid_vwap', 'microprice', 'imbalance', 'spread_twa']:
+        assert zero_quote[key] == first[key], key
+    # Offer side is quoted
+    assert zero_quote['offer_vwap'] == 103.
+    # Bars without rows stay empty
+    assert features.loc['2019-01-30 09:03:00'].isna().all()
+
+
+def posdump_frame(n_rows=500, seed=0):
+    """Posdump rows of one morning, with some empty book sides.
+    """
+    rng = np.random.default_rng(seed)
+    seconds = np.sort(np.r_[0, rng.integers(1, 3600, n_rows - 1)])
+    times = np.datetime64('2019-01-30T09:00:00') + seconds.astype('timedelta64[s]')
+    bid = 100 + np.cumsum(rng.normal(0, 0.05, n_rows)).round(2)
+    offer = bid + 0.1
+    bid[rng.random(n_rows) < 0.05] = 0.
+    offer[rng.random(n_rows) < 0.05] = 0.
+    return pd.DataFrame({
+        'time': nu.format_sheet_times(times, nu.NETFONDS_TIME_FORMAT),
+        'bid': bid,
+        'bid_depth': rng.integers(1, 1000, n_rows),
+        'bid_depth_total': rng.integers(1000, 9000, n_rows),
+        'offer': offer,
+        'offer_depth': rng.integers(1, 1000, n_rows),
+        'offer_depth_total': rng.integers(1000, 9000, n_rows),
+    })
+
+
+def test_ohlc_resample_features_keep_columns():
+    plain = nu.ohlc_resample(posdump_frame())
+    with_features = nu.ohlc_resample(posdump_frame(), features=True)
+    assert list(with_features.columns) == list(plain.columns) + nu.FEATURE_KEYS
+    pd.testing.assert_frame_equal(with_features[plain.columns], plain)
@@ -10,19 +10,29 @@ import netfonds_utils as nu
 import kvant_google_api as kga
 import logging
 import time
+import threading
 
 from googleapiclient.discovery import build
 from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 class Session(object):
     """Oauth2 session object for Google Drive and Sheets APIs.
+    
+    # Parameters:
+        cache_ttl: float
+            Seconds spreadsheet handles and token info are cached.
+        cache_maxsize: int
+            Max number of cached entries.
     """
-    def __init__(self):
+    def __init__(self, cache_ttl=600, cache_maxsize=1024):
         # Sheets API
         self.sheets = None
         # Drive API
         self.drive = None
         self.token = None
+        # Memoized reads bound to this authorization
+        self.cache = kga.TTLCache(ttl=cache_ttl, maxsize=cache_maxsize)
         
     def authorize(self, filename='assets/client_secret.json'):
         """Authorize Drive and Sheets APIs.
@@ -32,7 +42,9 @@ class Session(object):
                 Client secret json file destination.
         """
         self.token = kga.get_access_token(filename=filename)
-        credentials = kga.get_credentials(access_token=self.token)
+        credentials = kga.get_credentials(filename=filename, access_token=self.token)
+        # Cached handles belong to the old client
+        self.cache.invalidate()
 
         # Init Sheets gspread instance
         credentials.access_token = credentials.token
@@ -42,7 +54,8 @@ class Session(object):
         self.drive = build('drive', 'v3', credentials=credentials)
         
     def valid(self, expiry_threshold=1000):
-        """Check validity of session.
+        """Check validity of session. Token info is fetched once 
+        per cache entry, remaining duration is counted down locally.
         
         # Parameters:
             expiry_threshold: int
@@ -52,9 +65,37 @@ class Session(object):
         """
         get_str = \
             'https://www.googleapis.com/oauth2/v1/tokeninfo?access_token=' + self.token
-        token_info = r.get(get_str).json()
         
-        return token_info['expires_in'] >= expiry_threshold
+        def token_info():
+            return time.time(), r.get(get_str).json()['expires_in']
+        
+        fetched_at, expires_in = self.cache.get(('tokeninfo', self.token), token_info)
+        
+        return expires_in - (time.time() - fetched_at) >= expiry_threshold
+    
+    
+class BurstLimiter(object):
+    """Thread safe request burst limiter. One limiter is shared 
+    by all workers hitting the same API.
+    
+    # Parameters:
+        min_interval: float
+            Minimum number of seconds between two requests.
+    """
+    def __init__(self, min_interval=0.6):
+        self.min_interval = min_interval
+        self._lock = threading.Lock()
+        self._next_time = 0.
+        
+    def wait(self):
+        """Block until the next request is allowed.
+        """
+        with self._lock:
+            now = time.time()
+            wait_time = self._next_time - now
+            self._next_time = max(now, self._next_time) + self.min_interval
+        if wait_time > 0:
+            time.sleep(wait_time)
     
     
 class AssetUpdate(object):
@@ -69,12 +110,45 @@ class AssetUpdate(object):
             Resampling frequency if called, else append ticks.
             Ex. '1T', 'H', 'D', etc
             Warning: Only tested with '1T' (minute)
+        http: requests.Session
+            Pooled HTTP session for Netfonds requests, if shared.
+        netfonds_limiter, sheets_limiter: BurstLimiter
+            Rate limiters shared with other assets in the same run.
+        start_row: int
+            Resume upload from this row of the data, 
+            ex. rows acknowledged before a failed chunked upload.
+        chunk_rows, chunk_bytes: int
+            Max rows and approximate json bytes per append request.
+        netfonds_url: str
+            Netfonds base url, ex. a local replay server.
+        features: boolean
+            Add order book feature columns to resampled data, 
+            see nu.resample_features.
+        max_crossed_fraction: float
+            Max fraction of crossed rows kept, see nu.rejecting_reasons.
     """
-    def __init__(self, date, session, ticker, exchange='OSE', granularity=None):
+    def __init__(self, date, session, ticker, exchange='OSE', granularity=None,
+                 http=None, netfonds_limiter=None, sheets_limiter=None,
+                 start_row=0, chunk_rows=5000, chunk_bytes=2*1024**2,
+                 netfonds_url=nu.NETFONDS_URL, features=False,
+                 max_crossed_fraction=nu.MAX_CROSSED_FRACTION):
         self.drive = session.drive
         self.sheets = session.sheets
+        self.cache = session.cache
         self.ticker = ticker
         self.exchange = exchange
+        self.paper = nu.paper_name(ticker, exchange)
+        self.sheet_prefix = nu.sheet_prefix(ticker, exchange)
+        self.http = http
+        self.netfonds_limiter = netfonds_limiter
+        self.sheets_limiter = sheets_limiter
+        self.start_row = start_row
+        self.netfonds_url = netfonds_url
+        self.features = features
+        self.quality = None
+        self.max_crossed_fraction = max_crossed_fraction
+        self.chunk_rows = chunk_rows
+        self.chunk_bytes = chunk_bytes
         self.granularity = granularity
         self.resample = granularity is not None
         self.data = None
@@ -83,35 +157,58 @@ class AssetUpdate(object):
         # but should be easily expandable to f.ex. LOB data
         # with netfonds API client.
         
+        # Sheet time format, data times are datetime64 until upload
         if granularity is not None:
-            self.dt_format = '%Y-%m-%d %H:%M:%S'
+            self.dt_format = nu.SHEET_TIME_FORMAT
         else:
-            self.dt_format = '%Y%m%dT%H%M%S'
+            self.dt_format = nu.NETFONDS_TIME_FORMAT
         # For debugging
         self.error_log = []
         #
         
     def get_data(self):
-        """Download, parse and resample data from Netfonds.
+        """Download, parse, validate and resample data from Netfonds.
+        The 'time' column is kept as datetime64, see sink_data.
         
         # Returns:
             data: pd.DataFrame
+        # Raises:
+            nu.DataQualityError if validation rejects the data.
         """
         if self.nf_type is not 'posdump':
             raise NotImplementedError(
                 'nf_type "{}" not supported'.format(self.nf_type)
             )
-            
-        data = nu.get_date_depth(self.date, self.ticker, self.exchange)
+        
+        if self.netfonds_limiter is not None:
+            self.netfonds_limiter.wait()
+        data = nu.get_date_depth(
+            self.date, self.ticker, self.exchange, 
+            http=self.http, base_url=self.netfonds_url)
+        if data is not None and 'time' in data.columns:
+            try:
+                data['time'] = nu.parse_netfonds_times(data['time'])
+            except ValueError:
+                pass # Reported as bad_time_format
+        
+        # Reject bad data before any Sheets quota is spent
+        self.quality = nu.validate_depth(data)
+        n_rows = 0 if data is None else len(data)
+        reasons = nu.rejecting_reasons(
+            self.quality, n_rows, self.max_crossed_fraction)
+        if reasons:
+            raise nu.DataQualityError(self.paper, self.quality, reasons)
+        if 'crossed_book' in self.quality:
+            logging.warning('{}: Kept {} crossed rows of {}'.format(
+                self.paper, self.quality['crossed_book'], n_rows))
 
         if self.resample:
             # Resampling scheme
-            df = nu.ohlc_resample(data)
+            df = nu.ohlc_resample(data, features=self.features)
             df['time'] = df.index
             cols = df.columns.tolist()
             cols = cols[-1:] + cols[:-1]
             df = df[cols]
-            df['time'] = df['time'].map(str)
             data = df
             
         self.data = data
@@ -121,53 +218,102 @@ class AssetUpdate(object):
         """Ad-hoc parse datetimes and check if dt0 is before dt1.
         
         # Parameters:
-            dt0, dt1: str
-                Time strings
+            dt0, dt1: str or datetime64
+                Time strings in dt_format, or parsed datetimes
         # Returns:
             _: boolean
                 True is good
         """
-        if dt0 == 'date':
+        # Empty sheet or header only
+        if dt0 in ('', 'date', 'time'):
             return True
         try:
-            dt0 = nu.parse_netfonds_time(dt0, dt_format)
-            dt1 = nu.parse_netfonds_time(dt1, dt_format)
+            dt0, dt1 = [
+                nu.parse_netfonds_times([dt_i], dt_format)[0]
+                if isinstance(dt_i, str) else pd.Timestamp(dt_i).to_datetime64()
+                for dt_i in (dt0, dt1)
+            ]
             return dt0 < dt1
         except Exception as e:
             raise e
     
-    def upload(self):
-        """Uploads data to google drive.
-        Checks that data has not already been added to the sheet.
+    def sink_data(self):
+        """Data with 'time' formatted in bulk to sheet time strings.
+        
+        # Returns:
+            _: pd.DataFrame
+        """
+        return self.data.assign(
+            time=nu.format_sheet_times(self.data['time'], self.dt_format))
+    
+    def sheet_name(self):
+        """Sheet name of asset, ex. 'DNB_minute' or 'DNB_posdump'.
+        Exchanges other than nu.LEGACY_EXCHANGE include the exchange, 
+        ex. 'ERIC-B.ST_minute'.
         """
-        if self.data is None:
-            raise ValueError(
-                'No data in object. Asset: {}'.format(self.ticker))
         if self.granularity == '1T':
-            sheet_name = self.ticker + '_minute' # Should've named all minutes '1T'
+            return self.sheet_prefix + '_minute' # Should've named all minutes '1T'
         elif self.granularity is None:
-            sheet_name = '{}_{}'.format(self.ticker, self.nf_type)
+            return '{}_{}'.format(self.sheet_prefix, self.nf_type)
         else:
             # > Support all resampling freqs
             raise NotImplementedError()
-            sheet_name = '{}_{}'.format(self.ticker, self.granularity)
+            return '{}_{}'.format(self.sheet_prefix, self.granularity)
+    
+    def upload(self):
+        """Uploads data to google drive in chunks.
+        Checks that data has not already been added to the sheet.
+        Resumed uploads check that the sheet ends at the last acknowledged row.
+        
+        # Raises:
+            kga.ChunkedAppendError if a chunk fails, 
+            with the number of acknowledged rows.
+            ValueError if the data width differs from the sheet header.
+        """
+        if self.data is None:
+            raise ValueError(
+                'No data in object. Asset: {}'.format(self.ticker))
+        sheet_name = self.sheet_name()
             
-        # Open first worksheet of spreadsheet
+        # Open first worksheet of spreadsheet, every request waits on sheets_limiter
         try:
-            wks = self.sheets.open(sheet_name).sheet1
+            wks = kga.open_worksheet(
+                self.sheets, sheet_name, self.cache, self.sheets_limiter)
         except Exception as e:
             # For debugging
             self.error_log.append(e)
             #
-            if e['error']['code'] == 503:
+            if kga.api_error_code(e) in (429, 503):
                 time.sleep(5)
-                wks = self.sheets.open(sheet_name).sheet1
+                wks = kga.open_worksheet(
+                    self.sheets, sheet_name, self.cache, self.sheets_limiter)
+            else:
+                raise e
         
-        if self.datetime_check(
-                kga.last_filled_cell(wks),
-                self.data.iloc[0, 0],
-                self.dt_format):
-            response = kga.sheet_append(self.sheets, sheet_name, self.data)
+        data = self.sink_data()
+        # Rows wider or narrower than the header would shift columns
+        header = kga.sheet_header(wks, sheet_name, self.cache, self.sheets_limiter)
+        if len(header) and len(header) != data.shape[1]:
+            raise ValueError(
+                '{}: Header has {} columns, data has {}. Populate the header '
+                'with features={}, see kga.populate_sheet_header'.format(
+                    sheet_name, len(header), data.shape[1], self.features))
+        last_cell = kga.last_filled_cell(wks, limiter=self.sheets_limiter)
+        if self.start_row:
+            time_check = last_cell == data.iloc[self.start_row - 1, 0]
+        else:
+            time_check = self.datetime_check(
+                last_cell, self.data.iloc[0, 0], self.dt_format)
+        
+        if time_check:
+            response = kga.sheet_append(
+                self.sheets, sheet_name, data, 
+                start_row=self.start_row, 
+                chunk_rows=self.chunk_rows, 
+                chunk_bytes=self.chunk_bytes,
+                cache=self.cache,
+                limiter=self.sheets_limiter
+            )
         else:
             response = None # Datetime check failed
             raise ValueError('Datetime check failed')
@@ -182,24 +328,99 @@ class DriveUpdate(object):
         date: str
             If this parameters if not passed, get todays data
         tickers: list
-            If passed, manually define which tickers will be updated
+            If passed, manually define which tickers will be updated.
+            Ex. ['DNB', 'EQNR.OSE']. Tickers without exchange suffix
+            belong to exchange.
+        TICKERFILE: str
+            If passed, read tickers of exchange from this file 
+            instead of the ticker registry.
+        exchange: str
+            Exchange of tickers without exchange suffix.
+        exchanges: list of str
+            Exchanges updated in the run. If not passed, all 
+            exchanges of the ticker registry are updated.
+            With tickers, ValueError if a ticker is on another exchange.
+        tickerdir: str
+            Directory of '<EXCHANGE>_tickers.csv' ticker registry files.
+        max_workers: int
+            Number of assets updated concurrently. All workers share
+            one HTTP connection pool and the rate limiters.
+        netfonds_interval, sheets_interval: float
+            Minimum seconds between requests to Netfonds and Google Sheets.
+        chunk_rows, chunk_bytes: int
+            Max rows and approximate json bytes per sheet append request.
+        session: Session
+            Authorized session. If not passed, a Google OAuth session
+            is authorized. Ex. replay.ReplaySession for offline runs.
+        netfonds_url: str
+            Netfonds base url. Ex. url of replay.NetfondsReplayServer.
+        features: boolean
+            Add order book feature columns to resampled sheets. 
+            Sheet headers must include them, see kga.populate_sheet_header.
+        max_crossed_fraction: float
+            Max fraction of crossed rows before a ticker is rejected.
     """
     # > Maybe implement procedurally in lambda handler
     def __init__(self, date=None, tickers=None, 
-                 granularity='1T', TICKERFILE='assets/OSE_tickers.csv', 
-                 cred_verify_freq=10, exchange='OSE'):        
+                 granularity='1T', TICKERFILE=None, 
+                 cred_verify_freq=10, exchange='OSE', exchanges=None,
+                 tickerdir='assets', max_workers=4,
+                 netfonds_interval=0.1, sheets_interval=0.6,
+                 chunk_rows=5000, chunk_bytes=2*1024**2,
+                 session=None, netfonds_url=nu.NETFONDS_URL, features=False,
+                 max_crossed_fraction=nu.MAX_CROSSED_FRACTION):
         self.exchange = exchange
         self.granularity = granularity
-        self.max_deque_size = 1 # Make this changable
-        # Deque for asynchronous requests and general debugging
+        self.max_workers = max_workers
+        self.max_deque_size = max_workers
+        # Deque of recent assets for general debugging
         self.asset_deque = deque(maxlen=self.max_deque_size)
         self.retry_list = set()
         self.succeeded_tickers = set()
+        # {(ticker, exchange): rejecting reasons} of rejected tickers
+        self.rejected = {}
+        # {(ticker, exchange): validation report} of accepted tickers
+        self.quality = {}
+        # Rows acknowledged by failed chunked uploads, resumed on retry
+        self.acked_rows = {}
+        self.chunk_rows = chunk_rows
+        self.chunk_bytes = chunk_bytes
+        self.netfonds_url = netfonds_url
+        self.features = features
+        self.max_crossed_fraction = max_crossed_fraction
+        
+        # Shared by all workers
+        self.http = nu.get_http_session(pool_size=max_workers)
+        self.netfonds_limiter = BurstLimiter(netfonds_interval)
+        self.sheets_limiter = BurstLimiter(sheets_interval)
         
         if tickers is None:
-            self.tickers = nu.get_assets(tickerfile=TICKERFILE)
+            if TICKERFILE is not None:
+                self.registry = {exchange: nu.get_assets(tickerfile=TICKERFILE)}
+            else:
+                self.registry = nu.get_ticker_registry(
+                    tickerdir=tickerdir, exchanges=exchanges)
         else:
-            self.tickers = tickers
+            self.registry = {}
+            for paper in tickers:
+                ticker, exch = nu.split_paper(paper, default_exchange=exchange)
+                self.registry.setdefault(exch, []).append(ticker)
+            if exchanges is not None:
+                # Tickers outside exchanges would silently run elsewhere
+                outside = [
+                    nu.paper_name(ticker, exch) for exch in self.registry
+                    for ticker in self.registry[exch] if exch not in exchanges
+                ]
+                if len(outside):
+                    raise ValueError(
+                        'Tickers {} not on exchanges {}. Qualify tickers '
+                        'with their exchange, ex. DNB.ST'.format(outside, exchanges))
+        self.exchanges = list(self.registry)
+        # (ticker, exchange) pairs of all exchanges, scheduled in one run
+        self.tickers = [
+            (ticker, exch) for exch in self.registry 
+            for ticker in self.registry[exch]
+        ]
             
         if date is not None:
             self.date = date
@@ -208,13 +429,31 @@ class DriveUpdate(object):
             now = dt.datetime.now()
             self.date = now.strftime(dt_format)
             
-        self.session = Session()
-        self.session.authorize()
+        if session is None:
+            session = Session()
+            session.authorize()
+        self.session = session
         self.cred_verify_freq = cred_verify_freq
+        self._verify_lock = threading.Lock()
+        self._verify_count = 0
     
-    def update_asset(self, ticker, exchange='OSE'):
+    def verify_session(self):
+        """Reauthorize session if the token is about to expire. 
+        Checked every cred_verify_freq calls, safe to call from workers.
+        """
+        with self._verify_lock:
+            cnt = self._verify_count
+            self._verify_count += 1
+            if cnt % self.cred_verify_freq:
+                return
+            # Verify Oauth session
+            if not self.session.valid(expiry_threshold=3000):
+                self.session.authorize()
+                logging.info('Session token refreshed.')
+    
+    def update_asset(self, ticker, exchange=None):
         """Download/upload process. Function stores asset object 
-        in deque of recents.
+        in deque of recents. Called concurrently from the worker pool.
         
         # Parameters:
             ticker: str
@@ -223,25 +462,38 @@ class DriveUpdate(object):
             response: dict
                 Google sheets API sheet update response.
         """
+        if exchange is None:
+            exchange = self.exchange
+        self.verify_session()
         params = {
             'date': self.date, 
             'session': self.session, 
             'ticker': ticker, 
             'exchange': exchange,
-            'granularity': self.granularity
+            'granularity': self.granularity,
+            'http': self.http,
+            'netfonds_limiter': self.netfonds_limiter,
+            'sheets_limiter': self.sheets_limiter,
+            'start_row': self.acked_rows.get((ticker, exchange), 0),
+            'chunk_rows': self.chunk_rows,
+            'chunk_bytes': self.chunk_bytes,
+            'netfonds_url': self.netfonds_url,
+            'features': self.features,
+            'max_crossed_fraction': self.max_crossed_fraction
         }
         asset = AssetUpdate(**params)
         asset.get_data()
+        self.quality[(ticker, exchange)] = asset.quality
         response = asset.upload()
         # Push asset to asset obj deque
         self.asset_deque.append(asset)
         
         return response
         
-    # > Asynchronous can be implemented here
-    # > Burst limiter can be implemented here
     def run(self):
         """Main routine. Download-resample-upload process in RTF-package.
+        Tickers of all exchanges are submitted at once to one worker pool.
+        Workers verify the session every cred_verify_freq tickers.
         """
         # Logging config
         logging.basicConfig(
@@ -252,28 +504,71 @@ class DriveUpdate(object):
         # Only display messages at or above INFO level
         console.setLevel(logging.INFO)
 
-        for cnt, ticker in enumerate(self.tickers):
-            # Verify Oauth session
-            if not cnt % self.cred_verify_freq:
-                if not self.session.valid(expiry_threshold=3000):
-                    self.session.authorize()
-                    logging.info('Session token refreshed.')
-            try:
-                # Asset update scheme
-                response = self.update_asset(ticker, self.exchange)
-                
-                # Assumes that append process was a success
-                self.succeeded_tickers.add(ticker)
-                
-                logging.info(
-                    '{}: Updated cells: {}'.format(
-                        ticker, response['updates']['updatedCells'])
-                )
-            except Exception as e:
-                logging.error(e)
-                # Moving to retry list.
-                logging.info('Exception at ticker: {}.'.format(ticker))
-                self.retry_list.add(ticker)
+        jobs = list(self.tickers)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            futures = {
+                pool.submit(self.update_asset, ticker, exchange): (ticker, exchange)
+                for ticker, exchange in jobs
+            }
+            for future in as_completed(futures):
+                ticker, exchange = futures[future]
+                paper = nu.paper_name(ticker, exchange)
+                try:
+                    # Asset update scheme
+                    response = future.result()
+                    
+                    # Assumes that append process was a success
+                    self.succeeded_tickers.add((ticker, exchange))
+                    self.acked_rows.pop((ticker, exchange), None)
+                    self.rejected.pop((ticker, exchange), None)
+                    
+                    logging.info(
+                        '{}: Updated cells: {}'.format(
+                            paper, response['updates']['updatedCells'])
+                    )
+                except nu.DataQualityError as e:
+                    logging.warning(e)
+                    self.rejected[(ticker, exchange)] = e.reasons
+                    if e.retryable:
+                        self.retry_list.add((ticker, exchange))
+                except Exception as e:
+                    logging.error(e)
+                    if isinstance(e, kga.ChunkedAppendError):
+                        # Resume from last acknowledged chunk on retry
+                        self.acked_rows[(ticker, exchange)] = e.acked_rows
+                    # Moving to retry list.
+                    logging.info('Exception at ticker: {}.'.format(paper))
+                    self.retry_list.add((ticker, exchange))
+        
+        logging.info('Run summary: {}'.format(self.summary()))
+        
+    def summary(self):
+        """Run counters, including rejected tickers per validation 
+        failure and cache hits and misses.
+        
+        # Returns:
+            _: dict
+        """
+        rejections = {}
+        for reasons in self.rejected.values():
+            for reason in reasons:
+                rejections[reason] = rejections.get(reason, 0) + 1
+        # Validation findings of accepted tickers
+        reported = {}
+        for key, report in self.quality.items():
+            if key in self.rejected:
+                continue
+            for reason in report:
+                reported[reason] = reported.get(reason, 0) + 1
+        return {
+            'succeeded': len(self.succeeded_tickers),
+            'retry': len(self.retry_list),
+            'rejected': len(self.rejected),
+            'rejections': rejections,
+            'reported': reported,
+            'session_cache': self.session.cache.stats(),
+            'secrets_cache': kga.secrets_cache.stats()
+        }
                 
     def retry(self):
         """Retries download-resample-upload process for all items in retry_list